@@ -1,11 +1,18 @@
+import html
 import re
 import string
 import warnings
+from functools import lru_cache
 from bs4 import BeautifulSoup
 from markdown import markdown
 import spacy
 
 ESCAPE_PUNCT_RE = re.compile('[%s]' % re.escape(string.punctuation))
+# components that token.lemma_ depends on; everything else (e.g., parser, ner)
+# is skipped when tokenizing
+LEMMA_COMPONENTS = ('tok2vec', 'tagger', 'attribute_ruler', 'lemmatizer')
+PIPE_BATCH_SIZE = 1000
+WORD_RE = re.compile(r'[^\W_]+')
 
 __parser = None
 spacy_stopwords = None  # depends on the parser, should `load_spacy` before use
@@ -31,6 +38,11 @@ def get_parser():
     return __parser
 
 
+def unused_components(parser, needs_lemma=True):
+    needed = LEMMA_COMPONENTS if needs_lemma else ()
+    return [name for name in parser.pipe_names if name not in needed]
+
+
 def markdown_to_text(markdown_string):
     """ Converts a markdown string to plaintext """
 
@@ -76,6 +88,15 @@ def preprocess_e2e(x):
             (x)))
 
 
+@lru_cache(maxsize=2 ** 16)
+def normalize_token(token, lowercase=True, remove_punct=True):
+    # vocabularies are small next to token counts, so this mostly hits
+    if lowercase:
+        token = token.lower()
+    if remove_punct:
+        token = escape_punct(token)
+    return token.strip()
+
 def doc2tokens(parsed, remove_punct=True, remove_digit=True, remove_stops=True, remove_pron=True, lemmatize=True, lowercase=True):
     tokens = list()
     for token in parsed:
@@ -83,32 +104,71 @@ def doc2tokens(parsed, remove_punct=True, remove_digit=True, remove_stops=True,
             continue
         if remove_digit and token.is_digit:  # skip digits
             continue
-        if remove_stops and (token.lemma_ in spacy_stopwords):  # skip stopwords
+        lemma = token.lemma_
+        if remove_stops and (lemma in spacy_stopwords):  # skip stopwords
             continue
-        if remove_pron and (token.lemma_ == '-PRON-'):  # skip pronouns
+        if remove_pron and (lemma == '-PRON-'):  # skip pronouns
             continue
         else:
-            token = token.lemma_ if lemmatize else token.orth_
-            if lowercase:
-                token = token.lower()
-            if remove_punct:
-                token = escape_punct(token)
+            tokens.append(normalize_token(lemma if lemmatize else token.orth_,
+                                          lowercase=lowercase,
+                                          remove_punct=remove_punct))
+    return tokens
 
-            tokens.append(token.strip())
+def needs_spacy(remove_punct=True, remove_stops=True, remove_pron=True, lemmatize=True):
+    return lemmatize or remove_stops or remove_pron or not remove_punct
+
+def regex_tokenize(txt, remove_digit=True, lowercase=True):
+    """ Splits text into words without spaCy, dropping punctuation """
+    txt = preprocess_pre_tokenizing(txt)
+    if lowercase:
+        txt = txt.lower()
+    tokens = WORD_RE.findall(txt)
+    if remove_digit:
+        tokens = [token for token in tokens if not token.isdigit()]
+    return tokens
+
+def quick_tokenize(txt, remove_digit=True, lowercase=True):
+    """ Like `regex_tokenize`, but skips rendering markdown to text """
+    txt = html.unescape(remove_urls(txt or ''))
+    if lowercase:
+        txt = txt.lower()
+    tokens = WORD_RE.findall(txt)
+    if remove_digit:
+        tokens = [token for token in tokens if not token.isdigit()]
     return tokens
 
 def text2tokens(txt, remove_punct=True, remove_digit=True, remove_stops=True, remove_pron=True, lemmatize=True, lowercase=True):
+    if not needs_spacy(remove_punct=remove_punct, remove_stops=remove_stops, remove_pron=remove_pron, lemmatize=lemmatize):
+        return regex_tokenize(txt, remove_digit=remove_digit, lowercase=lowercase)
     parser = get_parser()
-    parsed = parser(preprocess_pre_tokenizing(txt))
+    disable = unused_components(parser, needs_lemma=lemmatize or remove_stops or remove_pron)
+    parsed = parser(preprocess_pre_tokenizing(txt), disable=disable)
     return doc2tokens(parsed=parsed, remove_punct=remove_punct, remove_digit=remove_digit, remove_stops=remove_stops, remove_pron=remove_pron, lemmatize=lemmatize, lowercase=lowercase)
 
+@lru_cache(maxsize=200000)
+def cached_text2tokens(txt, **options):
+    # repeated texts (bots, cross-posts, [deleted]) are tokenized once per process
+    return tuple(text2tokens(txt, **options))
+
 def texts2tokens(txt_stream, remove_punct=True, remove_digit=True, remove_stops=True, remove_pron=True, lemmatize=True, lowercase=True, n_process=-1):
+    if not needs_spacy(remove_punct=remove_punct, remove_stops=remove_stops, remove_pron=remove_pron, lemmatize=lemmatize):
+        for txt in txt_stream:
+            yield regex_tokenize(txt, remove_digit=remove_digit, lowercase=lowercase)
+        return
     parser = get_parser()
-    for parsed in parser.pipe(map(preprocess_pre_tokenizing, txt_stream), n_process=n_process):
+    disable = unused_components(parser, needs_lemma=lemmatize or remove_stops or remove_pron)
+    for parsed in parser.pipe(map(preprocess_pre_tokenizing, txt_stream), n_process=n_process, batch_size=PIPE_BATCH_SIZE, disable=disable):
         yield doc2tokens(parsed=parsed, remove_punct=remove_punct, remove_digit=remove_digit, remove_stops=remove_stops, remove_pron=remove_pron, lemmatize=lemmatize, lowercase=lowercase)
 
 def clean_items(item_stream, text_field, remove_punct=True, remove_digit=True, remove_stops=True, remove_pron=True, lemmatize=True, lowercase=True, n_process=-1):
+    if not needs_spacy(remove_punct=remove_punct, remove_stops=remove_stops, remove_pron=remove_pron, lemmatize=lemmatize):
+        for item in item_stream:
+            item[text_field] = ' '.join(regex_tokenize(item[text_field], remove_digit=remove_digit, lowercase=lowercase))
+            yield item
+        return
     parser = get_parser()
-    for parsed, item in parser.pipe(((preprocess_pre_tokenizing(i[text_field]), i) for i in item_stream), n_process=n_process, as_tuples=True):
+    disable = unused_components(parser, needs_lemma=lemmatize or remove_stops or remove_pron)
+    for parsed, item in parser.pipe(((preprocess_pre_tokenizing(i[text_field]), i) for i in item_stream), n_process=n_process, batch_size=PIPE_BATCH_SIZE, disable=disable, as_tuples=True):
         item[text_field] = ' '.join( doc2tokens(parsed=parsed, remove_punct=remove_punct, remove_digit=remove_digit, remove_stops=remove_stops, remove_pron=remove_pron, lemmatize=lemmatize, lowercase=lowercase))
         yield item
@@ -1,22 +1,24 @@
-import json
 import os
 import queue
+import re
 from abc import ABC, abstractmethod
-from json import JSONDecodeError
-from multiprocessing import Process, Queue, Event, Manager
+from multiprocessing import Process, Queue
+from typing import Callable
 
+import orjson
 from dotenv import load_dotenv
 
-from pullshift.preprocess_text import text2tokens, clean_items
-from pullshift.pushshift_file import decode_chunk, ZstdFileChunkReader, \
-    LineFileWriter
+from pullshift.preprocess_text import cached_text2tokens, clean_items, \
+    quick_tokenize, needs_spacy
+from pullshift.pushshift_file import split_chunk, unshare_chunk, batched, \
+    BATCH_SIZE, SENTINEL, ZstdFileChunkReader, ZstdFileReader, LineFileWriter, \
+    PipeChannel, RoundRobinQueue, SharedRingLines, extract_files, \
+    run_threaded
 
 
 class Processor(ABC, Process):
     def __init__(self, qin: Queue, qout: Queue):
         super(Processor, self).__init__()
-        self.stop_event_in = Event()
-        self.stop_event_out = Event()
         self.qin = qin
         self.qout = qout
 
@@ -25,108 +27,146 @@ class Processor(ABC, Process):
         pass
 
     def process_items(self):
-        done = False
-        while not done:
-            try:
-                item = self.qin.get(timeout=1)
-                processed = self.process_item(item)
-                if processed is not None:
-                    self.qout.put(processed)
-            except queue.Empty as e:  # queue closed
-                if self.stop_event_in.is_set():
-                    done = True
-                else:
-                    pass
-
-    def close_processor(self):
-        self.stop_event_out.set()
+        for batch in iter(self.qin.get, SENTINEL):
+            processed = [self.process_item(item) for item in batch]
+            processed = [item for item in processed if item is not None]
+            if processed:
+                self.qout.put(processed)
 
     def run(self) -> None:
         self.process_items()
-        self.close_processor()
+        # ends this processor's stream, for channels that track producers
+        self.qout.close()
         self.close()
 
-    def stop(self):
-        self.stop_event_in.set()
+    def stop(self):  # one sentinel per call, consumed by a single processor
+        self.qin.put(SENTINEL)
+
+
+# each sets text, fullname, parent_fullname, link_fullname for its type:
+# text is the body of comments, the title of link submissions, and
+# title + selftext of self submissions
+def _normalize_comment(item: dict):
+    item['text'] = item.pop('body')
+    item['fullname'] = f"t1_{item.pop('id')}"
+    item['parent_fullname'] = item.pop('parent_id')
+    item['link_fullname'] = item.pop('link_id')
+
+
+def _normalize_selftext_submission(item: dict):
+    item['text'] = "\n".join([item.pop('title'), item.pop('selftext')])
+    item['fullname'] = fullname = f"t3_{item.pop('id')}"
+    item['parent_fullname'] = None
+    item['link_fullname'] = fullname
+
+
+def _normalize_link_submission(item: dict):
+    item['text'] = item.pop('title')
+    item['fullname'] = fullname = f"t3_{item.pop('id')}"
+    item['parent_fullname'] = None
+    item['link_fullname'] = fullname
+
+
+_NORMALIZERS = {
+    'comment': _normalize_comment,
+    'selftext_submission': _normalize_selftext_submission,
+    'link_submission': _normalize_link_submission,
+}
 
 
 def normalize_text(item: dict, **kwargs):
-    contribution_type = "comment"
-    if 'is_self' in item:
-        if item['is_self']:
-            contribution_type = "selftext_submission"
-        else:
-            contribution_type = "link_submission"
+    if 'is_self' not in item:
+        contribution_type = "comment"
+    elif item['is_self']:
+        contribution_type = "selftext_submission"
+    else:
+        contribution_type = "link_submission"
     item['contribution_type'] = contribution_type
-
-    if contribution_type == 'comment':
-        item['text'] = item.pop('body')
-    elif contribution_type == 'selftext_submission':
-        item['text'] = "\n".join([item.pop('title'), item.pop('selftext')])
-    elif contribution_type == 'link_submission':
-        item['text'] = item.pop('title')
-    # title if link sub; title+self if self sub; text if comment
-
-    if contribution_type in set(['selftext_submission', 'link_submission']):
-        item['fullname'] = "t3_" + item.pop('id')
-        item['parent_fullname'] = None
-        item['link_fullname'] = item['fullname']
-    elif contribution_type == 'comment':
-        item['fullname'] = "t1_" + item.pop('id')
-        item['parent_fullname'] = item.pop('parent_id')
-        item['link_fullname'] = item.pop('link_id')
+    _NORMALIZERS[contribution_type](item)
     return item
 
 
-def keep_fields(item: dict, fields: set[str]):
-    return {k: v for k, v in item.items() if k in fields}
+def keep_fields(item: dict, fields: tuple[str, ...]):
+    # items have many more keys than are kept, so walk `fields` instead; a
+    # tuple also fixes the key order of the output, unlike a set
+    return {k: item[k] for k in fields if k in item}
 
 
 def keep_contribution(item: dict, fields_and_values: dict[str:set[str]]):
     for field, values in fields_and_values.items():
-        if (field not in item) or (item[field] not in values):
+        if item.get(field) not in values:
             return None
     return item
 
 
+def keep_field_value(item: dict, field: str, values: frozenset[str]):
+    return item if item.get(field) in values else None
+
+
+class FieldValuePrescreen:
+    """ Tests a raw json line for `field` having one of `values`, before parsing
+
+    Matches in nested objects pass too, so keep the exact filter in `funcs`.
+    Values with json escapes (e.g., \\uXXXX, \\") can't be compared raw, so
+    they always pass on to that filter.
+    """
+
+    def __init__(self, field: str, values: set[str]):
+        # the value up to its closing quote, or up to its first escape
+        self.pattern = re.compile(
+            rb'"%s"\s*:\s*"([^"\\]*)(["\\])' % re.escape(field.encode('utf8')))
+        self.values = frozenset(value.encode('utf8') for value in values)
+
+    def __call__(self, line: bytes):
+        return any((end == b'\\') or (value in self.values)
+                   for value, end in self.pattern.findall(line))
+
+
 def to_string(item: dict, **args):
-    return json.dumps(item)
+    return orjson.dumps(item)
 
 
 def clean_text(item, text_field='text', remove_punct=True, remove_digit=True,
                remove_stops=True, remove_pron=True,
                lemmatize=True, lowercase=True):
     item[text_field] = " ".join(
-        text2tokens(item[text_field], remove_punct=remove_punct,
-                    remove_digit=remove_digit,
-                    remove_stops=remove_stops,
-                    remove_pron=remove_pron,
-                    lemmatize=lemmatize,
-                    lowercase=lowercase, ))
+        cached_text2tokens(item[text_field], remove_punct=remove_punct,
+                           remove_digit=remove_digit,
+                           remove_stops=remove_stops,
+                           remove_pron=remove_pron,
+                           lemmatize=lemmatize,
+                           lowercase=lowercase, ))
+    return item
+
+
+def fast_clean_text(item, text_field='text', remove_digit=True, lowercase=True):
+    # clean_text minus markdown rendering, stopwords and lemmas: one regex scan
+    item[text_field] = " ".join(
+        quick_tokenize(item[text_field], remove_digit=remove_digit,
+                       lowercase=lowercase))
     return item
 
 
 class QueueIterator:
-    def __init__(self, qin, stop_event):
+    def __init__(self, qin):
         self.qin = qin
-        self.stop_event = stop_event
+        self.batch = iter(())
 
     def __iter__(self):
         return self
 
     def __next__(self):  # Python 2: def next(self)
-        done = False
-        while not done:
-            try:
-                item = self.qin.get(timeout=1)
+        while True:
+            for item in self.batch:
                 if item is not None:
                     return item
-            except queue.Empty as e:  # queue closed
-                if self.stop_event.is_set():
-                    done = True
-                    raise StopIteration
-                else:
-                    pass
+            self.batch = iter(self.next_batch())
+
+    def next_batch(self):
+        batch = self.qin.get()
+        if batch is SENTINEL:
+            raise StopIteration
+        return batch
 
 
 class StreamProcessor(Processor):
@@ -136,11 +176,11 @@ class StreamProcessor(Processor):
         self.func = func
 
     def process_items(self):
-        for processed in self.func(
-            item_stream=QueueIterator(self.qin, self.stop_event_in),
+        for batch in batched(self.func(
+            item_stream=QueueIterator(self.qin),
             **self.kwargs
-        ):
-            self.qout.put(processed)
+        ), BATCH_SIZE):
+            self.qout.put(batch)
 
     def process_item(self, item):
         pass
@@ -162,75 +202,213 @@ class SpacyProcessor(Processor):
         self.n_processes = n_processes
 
     def process_items(self):
-        for processed in clean_items(
-            item_stream=QueueIterator(self.qin, self.stop_event_in),
+        for batch in batched(clean_items(
+            item_stream=QueueIterator(self.qin),
             text_field=self.text_field,
             n_process=self.n_processes,
             remove_punct=self.remove_punct, remove_digit=self.remove_digit,
             remove_stops=self.remove_stops, remove_pron=self.remove_pron,
             lemmatize=self.lemmatize, lowercase=self.lowercase,
-        ):
-            self.qout.put(processed)
+        ), BATCH_SIZE):
+            self.qout.put(batch)
 
     def process_item(self, item):
         pass
 
 
 class ChunkProcessor(Processor):
+    def __init__(self, qin: Queue, qout: Queue,
+                 prescreen: Callable[[bytes], bool] = None):
+        super(ChunkProcessor, self).__init__(qin=qin, qout=qout)
+        self.prescreen = prescreen
+
     def process_items(self):
-        done = False
-        while not done:
-            try:
-                chunk = self.qin.get(timeout=1)
-                for line in decode_chunk(chunk=chunk):
-                    try:
-                        loaded = json.loads(line)
-                        processed = self.process_item(loaded)
-                        if processed is not None:
-                            self.qout.put(processed)
-                    except JSONDecodeError as e:
-                        if line and len(line.strip()):
-                            print(f'error decoding json object from {line}')
-            except queue.Empty as e:  # queue closed
-                if self.stop_event_in.is_set():
-                    done = True
-                else:
-                    pass
+        for chunks in iter(self.qin.get, SENTINEL):
+            for batch in batched(self.process_chunks(chunks), BATCH_SIZE):
+                self.qout.put(batch)
+
+    def process_chunks(self, chunks):
+        for shared in chunks:
+            for line in split_chunk(chunk=unshare_chunk(shared)):
+                if (self.prescreen is not None) and not self.prescreen(line):
+                    continue
+                try:
+                    loaded = orjson.loads(line)
+                    processed = self.process_item(loaded)
+                    if processed is not None:
+                        yield processed
+                except orjson.JSONDecodeError as e:
+                    if line and len(line.strip()):
+                        print(f'error decoding json object from {line}')
 
     def process_item(self, item):
         return item
 
 
+def _inline_keep_field_value(i, field, values):
+    return [f'    if item.get({field!r}) not in v{i}:',
+            '        return None'], {f'v{i}': values}
+
+
+def _inline_keep_contribution(i, fields_and_values):
+    lines = []
+    for j, (field, values) in enumerate(fields_and_values.items()):
+        lines.append(f'    if item.get({field!r}) not in v{i}_{j}:')
+        lines.append('        return None')
+    return lines, {f'v{i}_{j}': values for j, values
+                   in enumerate(fields_and_values.values())}
+
+
+def _inline_keep_fields(i, fields):
+    lines = ['    kept = dict()']
+    # in the given order, or sorted if `fields` has none
+    for field in (fields if isinstance(fields, (tuple, list)) else sorted(fields)):
+        lines.append(f'    if {field!r} in item:')
+        lines.append(f'        kept[{field!r}] = item[{field!r}]')
+    lines.append('    item = kept')
+    return lines, dict()
+
+
+# stages that compile_pipeline writes out as code, with their kwargs as literals
+_INLINE = {
+    keep_field_value: _inline_keep_field_value,
+    keep_contribution: _inline_keep_contribution,
+    keep_fields: _inline_keep_fields,
+}
+
+
+def compile_pipeline(funcs: list):
+    """ Generates a single function chaining `funcs`, a list of (func, kwargs)
+
+    Each kwarg is bound as a constant of the generated code, so calls neither
+    loop over the stages nor unpack kwargs dicts. Stages in `_INLINE` are
+    specialized into the function body instead of being called.
+    """
+    namespace = dict()
+    lines = ['def fused(item):']
+    for i, (func, args) in enumerate(funcs):
+        lines.append('    if item is None:')
+        lines.append('        return None')
+        if func in _INLINE:
+            body, constants = _INLINE[func](i, **args)
+            lines.extend(body)
+            namespace.update(constants)
+            continue
+        namespace[f'f{i}'] = func
+        call_args = ['item']
+        for j, (name, value) in enumerate(args.items()):
+            namespace[f'a{i}_{j}'] = value
+            call_args.append(f'{name}=a{i}_{j}')
+        lines.append(f'    item = f{i}({", ".join(call_args)})')
+    lines.append('    return item')
+    exec('\n'.join(lines), namespace)
+    return namespace['fused']
+
+
+class CompiledPipeline:
+    def __init__(self, funcs: list):
+        self.funcs = funcs
+        self.fused = compile_pipeline(funcs)
+
+    def __call__(self, item):
+        return self.fused(item)
+
+    # generated functions do not pickle, so rebuild them on the other side
+    def __getstate__(self):
+        return {'funcs': self.funcs}
+
+    def __setstate__(self, state):
+        self.__init__(state['funcs'])
+
+
+# stages that cost about as much as parsing a line, unlike e.g. clean_text
+CHEAP_FUNCS = frozenset([keep_fields, keep_contribution, keep_field_value,
+                         normalize_text, fast_clean_text, to_string])
+
+
+def batch_stages(funcs: list):
+    """ Splits `funcs` into stages that each take and return a list of items
+
+    clean_text stages that need spaCy become kwargs for `clean_items`, which
+    parses the whole list with one `nlp.pipe` call; the runs of funcs in
+    between become CompiledPipelines.
+    """
+    spacy_options = ('remove_punct', 'remove_stops', 'remove_pron', 'lemmatize')
+    stages, run = list(), list()
+    for func, args in funcs:
+        if (func is clean_text) and needs_spacy(
+                **{k: v for k, v in args.items() if k in spacy_options}):
+            if run:
+                stages.append(CompiledPipeline(run))
+                run = list()
+            stages.append({'text_field': 'text', **args})
+        else:
+            run.append((func, args))
+    if run:
+        stages.append(CompiledPipeline(run))
+    return stages
+
+
 class Pipeline(Processor):
     def __init__(self, qin: Queue, qout: Queue, funcs: list):
         super(Pipeline, self).__init__(qin=qin, qout=qout)
         self.funcs = funcs
+        self.pipeline = CompiledPipeline(funcs)
+        self.stages = batch_stages(funcs)
+
+    def process_items(self):
+        for batch in iter(self.qin.get, SENTINEL):
+            processed = self.process_batch(batch)
+            if processed:
+                self.qout.put(processed)
+
+    def process_batch(self, batch):
+        for stage in self.stages:
+            if isinstance(stage, CompiledPipeline):
+                batch = [item for item in map(stage.fused, batch)
+                         if item is not None]
+            else:  # processors already run in parallel, so one spaCy process
+                batch = list(clean_items(batch, n_process=1, **stage))
+        return batch
 
     def process_item(self, item):
-        for (func, args) in self.funcs:
-            if item is None:
-                return None
-            else:
-                item = func(item, **args)
-        return item
+        return self.pipeline.fused(item)
 
 
-class ChunkPipeline(ChunkProcessor, Pipeline):
-    def process_item(self, item):
-        return Pipeline.process_item(self, item)
+class ChunkPipeline(ChunkProcessor):
+    def __init__(self, qin: Queue, qout: Queue, funcs: list,
+                 prescreen: Callable[[bytes], bool] = None):
+        super(ChunkPipeline, self).__init__(qin=qin, qout=qout,
+                                            prescreen=prescreen)
+        self.funcs = funcs
+        self.pipeline = CompiledPipeline(funcs)
 
+    def process_item(self, item):
+        return self.pipeline.fused(item)
 
-def go(fins, fout, funcs, n_processors=10, queue_size=10 ** 6):
-    m = Manager()
-    q_to_process = m.Queue(maxsize=queue_size)
-    q_from_process = m.Queue()
-    chunkers = [ZstdFileChunkReader(q_to_process, fin) for fin in fins]
 
+def go(fins, fout, funcs, n_processors=10, queue_size=10 ** 6,
+       prescreen=None):
     if (n_processors is None) or (n_processors <= 0):
         n_processors = os.cpu_count()
-    # set up processors
-    processors = [ChunkPipeline(q_to_process, q_from_process, funcs=funcs)
-                  for _ in range(n_processors)]
+    # with a reader per core and only cheap stages, readers can run the
+    # pipeline themselves and the processor stage is pure overhead
+    if (len(fins) >= n_processors) and \
+            all(func in CHEAP_FUNCS for func, _ in funcs):
+        return go_fused(fins, fout, funcs, queue_size=queue_size,
+                        prescreen=prescreen)
+
+    # each processor gets its own queue from the readers and its own pipe to
+    # the writer, so no channel has more than a few processes contending
+    q_to_process = RoundRobinQueue(n_processors,
+                                   maxsize=max(1, queue_size // n_processors))
+    chunkers = [ZstdFileChunkReader(q_to_process, fin) for fin in fins]
+
+    q_from_process = PipeChannel(n_processors)
+    processors = [ChunkPipeline(q_to_process.queues[i],
+                                q_from_process.senders[i],
+                                funcs=funcs, prescreen=prescreen)
+                  for i in range(n_processors)]
 
     # set up writer
     wp = LineFileWriter(in_queue=q_from_process, fpath=fout)
@@ -248,7 +426,8 @@ def go(fins, fout, funcs, n_processors=10, queue_size=10 ** 6):
     for processor in processors:
         processor.stop()
 
-    # wait for processors to stop and signal writer
+    # processors end their pipes to the writer as they finish; stopping it
+    # too still lets it take everything they sent first
     for processor in processors:
         processor.join()
     wp.stop()
@@ -257,6 +436,61 @@ def go(fins, fout, funcs, n_processors=10, queue_size=10 ** 6):
     print('finished!')
 
 
+def go_fused(fins, fout, funcs, queue_size=10 ** 6, prescreen=None,
+             ring_size=None):
+    # readers run the whole pipeline right after parsing, so there are no
+    # processors and only the serialized output crosses the queue; with
+    # `ring_size` (bytes), the lines go through a shared memory ring instead
+    # of being pickled through a pipe
+    q = Queue(maxsize=queue_size) if ring_size is None \
+        else SharedRingLines(ring_size)
+    pipeline = CompiledPipeline(funcs)
+    readers = [ZstdFileReader(q, fin, prefilter=pipeline, prescreen=prescreen)
+               for fin in fins]
+    wp = LineFileWriter(in_queue=q, fpath=fout)
+
+    wp.start()
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    wp.stop()
+    wp.join()
+    if ring_size is not None:
+        q.close()
+        q.unlink()
+    failed = [reader.fpath for reader in readers if reader.exitcode]
+    if failed:
+        raise RuntimeError(f'failed reading {", ".join(failed)}')
+    if wp.exitcode:
+        raise RuntimeError(f'failed writing {fout}')
+
+    print('finished!')
+
+
+def go_threaded(fins, fout, funcs, queue_size=10 ** 6, prescreen=None):
+    # like go_fused, with readers as threads of this process: for a handful
+    # of files, this saves the processes and the pickling between them
+    q = queue.Queue(maxsize=queue_size)
+    pipeline = CompiledPipeline(funcs)
+    readers = [ZstdFileReader(q, fin, prefilter=pipeline, prescreen=prescreen)
+               for fin in fins]
+    run_threaded(readers, LineFileWriter(in_queue=q, fpath=fout))
+
+    print('finished!')
+
+
+def go_sharded(fins, fout, funcs, n_processors=10, prescreen=None):
+    # each worker runs read -> funcs -> write on a whole file, so nothing
+    # crosses a queue; the per-file outputs are concatenated at the end
+    if (n_processors is None) or (n_processors <= 0):
+        n_processors = os.cpu_count()
+    extract_files(fins, fout, func=CompiledPipeline(funcs),
+                  prescreen=prescreen, nthreads=n_processors)
+
+    print('finished!')
+
+
 # Yield successive n-sized
 # chunks from l.
 def divide_chunks(l, n):
@@ -276,14 +510,13 @@ def main():
     with open(subreddit_fname, encoding='utf8') as f:
         for l in f:
             subs.append(l.split('\t')[0])
-    subs = set(subs)
+    subs = frozenset(subs)
     funcs = [
-        (keep_contribution, dict(fields_and_values={"subreddit": subs})),
+        (keep_field_value, dict(field="subreddit", values=subs)),
         (normalize_text, dict()),
-        (keep_fields, {'fields': set(['fullname', 'subreddit', 'text', 'contribution_type'])}),
+        (keep_fields, {'fields': ('fullname', 'subreddit', 'contribution_type', 'text')}),
         (to_string, dict())
     ]
-    queue_size = 10 ** 4
     n_processors = 20
 
     for year in range(2005, 2019):
@@ -301,19 +534,21 @@ def main():
         fins = [f for f in fins if os.path.exists(f)]
 
         # for fins_ in divide_chunks(fins, 12):
-        go(fins=fins, fout=fout, funcs=funcs, n_processors=n_processors,
-               queue_size=queue_size)
+        go_sharded(fins=fins, fout=fout, funcs=funcs,
+                   n_processors=n_processors,
+                   prescreen=FieldValuePrescreen("subreddit", subs))
 
 
 def bench():
+    subs = frozenset(['climateskeptics', 'climatechange', 'science',
+                      'conspiracy', 'conservative', 'moonhoax',
+                      'flatearth', 'nasa', 'politics'])
     go(fins=["/data/shruti/Reddit/submissions/RS_2024_01.zst"],
        fout='pullshift.njson', funcs=[
-            (keep_contribution, dict(fields_and_values={"subreddit": set(
-                ['climateskeptics', 'climatechange', 'science', 'conspiracy',
-                 'conservative', 'moonhoax',
-                 'flatearth', 'nasa', 'politics'])})),
+            (keep_field_value, dict(field="subreddit", values=subs)),
             (to_string, dict())
-        ], n_processors=16, queue_size=2 ** 22)
+        ], n_processors=16, queue_size=2 ** 22,
+       prescreen=FieldValuePrescreen("subreddit", subs))
 
 
 if __name__ == '__main__':
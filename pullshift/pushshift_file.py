@@ -1,167 +1,685 @@
-import gzip
 import io
-import json
 import os
+import pickle
 import queue
+import shutil
+import struct
+import threading
+from collections import deque
 from abc import ABC, abstractmethod
-from gzip import GzipFile
-from json import JSONDecodeError
+from contextlib import contextmanager
+try:  # isal's igzip is a faster drop-in for gzip, with the same output format
+    from isal.igzip import GzipFile
+except ImportError:
+    from gzip import GzipFile
 from copy import deepcopy
-from multiprocessing import Queue, Process, Event, Manager, Pool
+from multiprocessing import Queue, Process, Pool, Pipe, Lock, Condition, \
+    resource_tracker
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
 from typing import Callable, Optional
 # from multiprocessing.dummy import Pool
 from tqdm import tqdm
 
+import orjson
 import zstandard as zstd
 
 ZST_NUM_BYTES = 2 ** 24
 
-EXTRA_BUFFER = 2 ** 22
+READ_BUFFER_SIZE = 2 ** 20
+
+COMPRESSED_READ_SIZE = 2 ** 22
+
+WRITE_BUFFER_SIZE = 2 ** 22
+
+MULTI_WRITE_BUFFER_SIZE = 2 ** 18  # per output file, and there may be many
+
+DECOMPRESS_AHEAD = 8  # blocks decompressed ahead of parsing, by a thread
+
+BATCH_SIZE = 512  # items per queue message
+
+SENTINEL = None  # ends a stream of batches; unlike object(), survives pickling
+
+
+def new_decompressor():
+    # a decompressor serves one stream at a time, and a thread may have
+    # several open, so each stream gets its own
+    return zstd.ZstdDecompressor(max_window_size=2147483648)
+
+
+def _open_sequential_scan(path, flags):
+    # windows' FILE_FLAG_SEQUENTIAL_SCAN; elsewhere, fadvise does the same
+    return os.open(path, flags | getattr(os, 'O_SEQUENTIAL', 0))
+
+
+@contextmanager
+def open_sequential(fpath):
+    """ Opens a file for reading front to back, asking the os to read ahead
+
+    The file is read once, so its pages are dropped from the cache once
+    it's closed rather than pushing out pages that will be used again.
+    """
+    with open(fpath, 'rb', opener=_open_sequential_scan) as fh:
+        if hasattr(os, 'posix_fadvise'):  # not on windows or macos
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        try:
+            yield fh
+        finally:
+            if hasattr(os, 'posix_fadvise') and not fh.closed:
+                os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
 
 
 def decompress_by_chunk(infile):
-    zst_num_bytes = ZST_NUM_BYTES
-    dctx = zstd.ZstdDecompressor(max_window_size=2147483648)
-    with dctx.stream_reader(infile) as reader:
-        buffer = b""
+    """ Yields ~ZST_NUM_BYTES chunks of a zst file, each made of whole lines """
+    dctx = new_decompressor()
+    with dctx.stream_reader(infile, read_size=COMPRESSED_READ_SIZE,
+                            read_across_frames=True, closefd=False) as reader:
+        tail = b""
         while True:
-            chunk = reader.read(zst_num_bytes)
+            chunk = reader.read(ZST_NUM_BYTES)
             if not chunk:
                 break
-            yield buffer + chunk
-            buffer = chunk[-EXTRA_BUFFER:]
+            data = tail + chunk
+            cut = data.rfind(b'\n') + 1
+            if cut:
+                yield data[:cut]
+            tail = data[cut:]
+        if tail:
+            yield tail
+
+
+def rfind_newline(view, end):
+    """ Index of the last newline in view[:end], -1 if there is none """
+    window = 2 ** 16  # lines are short, so the first window nearly always hits
+    while end > 0:
+        start = max(end - window, 0)
+        idx = bytes(view[start:end]).rfind(b'\n')
+        if idx >= 0:
+            return start + idx
+        end = start
+    return -1
+
+
+def split_chunk(chunk):
+    for line in chunk.split(b'\n'):
+        if line:
+            yield line
+
+
+def batched(items, n):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def decompress_to_shared(infile):
+    """ Same chunks as `decompress_by_chunk`, but decompressed straight into
+    shared memory blocks, yielded as (name, size) for `unshare_chunk` """
+    dctx = new_decompressor()
+    with dctx.stream_reader(infile, read_size=COMPRESSED_READ_SIZE,
+                            read_across_frames=True, closefd=False) as reader:
+        tail = b""
+        while True:
+            end = len(tail) + ZST_NUM_BYTES
+            shm = SharedMemory(create=True, size=end)
+            shm.buf[:len(tail)] = tail
+            size = len(tail)
+            while size < end:
+                with shm.buf[size:end] as view:
+                    n_read = reader.readinto(view)
+                if not n_read:
+                    break
+                size += n_read
+            # the stream is over once a block is left short; otherwise the
+            # partial line at its end moves on to the next block
+            cut = size if size < end else rfind_newline(shm.buf, size) + 1
+            tail = bytes(shm.buf[cut:size])
+            if not cut:
+                shm.close()
+                shm.unlink()
+                if size < end:
+                    break
+                continue
+            # ownership passes to the consumer, which unlinks the block once read
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            shm.close()
+            yield shm.name, cut
+            if size < end:
+                break
 
 
-def decode(chunk, keep_prefix=True, encoding='utf-8', max_retries=4):
-    retries_left = max_retries
-    while retries_left > 0:
+def unshare_chunk(shared):
+    if isinstance(shared, bytes):
+        return shared
+    name, size = shared
+    shm = SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def decompressed_blocks(fh):
+    """ Yields the decompressed content of a zst file in READ_BUFFER_SIZE blocks """
+    reader = new_decompressor().stream_reader(fh,
+                                              read_size=COMPRESSED_READ_SIZE,
+                                              read_across_frames=True)
+    while True:
+        block = reader.read(READ_BUFFER_SIZE)
+        if not block:
+            break
+        yield block
+
+
+def read_ahead(blocks, depth: int):
+    """ Iterates `blocks` in a background thread, up to `depth` blocks ahead
+
+    zstandard releases the GIL while decompressing, so the next blocks are
+    decompressed while the caller is busy parsing the current one.
+    """
+    ahead = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def produce():
         try:
-            return chunk.decode(encoding)
-        except UnicodeDecodeError as e:
-            chunk = keep_prefix and chunk[:-1] or chunk[1:]
-            retries_left -= 1
-            if retries_left <= 0:
-                raise e
-
-
-def decode_chunk(chunk):
-    previous_line = ''
-    if len(
-        chunk) != ZST_NUM_BYTES:  # TODO: should handle also the case of the last chunk; this is assuming that the last chunk won't be exactly the size of the first
-        prefix = decode(chunk[:EXTRA_BUFFER], keep_prefix=False)
-        chunk = chunk[EXTRA_BUFFER:]
-        # check that this does not end with a complete line
-        if not prefix.endswith('\n'):
-            previous_lines = prefix.split("\n")
-            if len(previous_lines) > 1:
-                previous_line = previous_lines[-1]
-        # else:
-        #     print("prefix: ",prefix)
-    # print(previous_line)
-    string_data = previous_line + decode(chunk, keep_prefix=True)
-    lines = string_data.split("\n")
-    # check that this does not end with a complete line
-    if not string_data.endswith('\n'):
-        lines = lines[:-1]
-    yield from lines
-
-
-def decompress(fh):
-    reader = zstd.ZstdDecompressor(max_window_size=2147483648).stream_reader(fh)
-    yield from io.TextIOWrapper(reader, encoding='utf-8')
+            for block in blocks:
+                ahead.put(block)
+                if stopped.is_set():
+                    return
+            ahead.put(SENTINEL)
+        except BaseException as e:  # re-raised in the consuming thread
+            ahead.put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        for block in iter(ahead.get, SENTINEL):
+            if isinstance(block, BaseException):
+                raise block
+            yield block
+    finally:  # also when the caller stops early: unblock and end the thread
+        stopped.set()
+        while producer.is_alive():
+            try:
+                ahead.get(timeout=.1)
+            except queue.Empty:
+                pass
+        producer.join()
+
+
+def decompress(fh, ahead: int = DECOMPRESS_AHEAD):
+    """ Yields the non-empty lines of a zst file as bytes
+
+    With `ahead`, up to that many blocks are decompressed in a background
+    thread, overlapping decompression with the caller's work.
+    """
+    blocks = decompressed_blocks(fh)
+    if ahead:
+        blocks = read_ahead(blocks, ahead)
+    tail = b""
+    for block in blocks:
+        # bytes.split finds the newlines in C, way faster than find() calls
+        lines = (tail + block).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if tail:
+        yield tail
 
 
 class Reader(ABC, Process):
+    batch_size = BATCH_SIZE
+
     def __init__(self, out_queue: Queue, fpath: str):
         super(Reader, self).__init__()
-        self.stop_event = Event()
         self.out_queue = out_queue
         self.fpath = fpath
+        self._batch = []
 
     @abstractmethod
     def read(self, **args):
         pass
 
     def forward_item(self, item):
-        self.out_queue.put(item)
+        self._batch.append(item)
+        if len(self._batch) >= self.batch_size:
+            self.flush_items()
+
+    def flush_items(self):
+        if self._batch:
+            self.out_queue.put(self._batch)
+            self._batch = []
 
     def run(self):
-        self.read()
-        self.close_reader()
+        try:
+            self.read()
+        finally:  # flush even if reading fails, so nothing parsed is lost
+            self.close_reader()
         self.close()
 
     def close_reader(self):
         print('closing reader')
-        try:
-            self.stop_event.set()
-            # self.out_queue.close()
-            if self.fpath:
-                print(f'closed {self.fpath}')
-        except Exception as e:
-            print('error in closing the barrier')
-            print(e)
+        self.flush_items()
+        if self.fpath:
+            print(f'closed {self.fpath}')
+
 
-    def join(self, timeout: Optional[float] = None) -> None:
-        self.stop_event.wait(timeout=timeout)
+def parse_line(line, fields: Optional[frozenset] = None,
+               prefilter: Callable[[dict], Optional[object]] = None):
+    """ Parses one json line, keeping only `fields` when given
+
+    `prefilter` then maps the item to whatever should be queued, or to None
+    to drop it
+    """
+    item = orjson.loads(line)
+    if fields is not None:
+        item = {k: item[k] for k in fields if k in item}
+    if prefilter is not None:
+        item = prefilter(item)
+    return item
 
 
 class JsonlFileReader(Reader):
+    def __init__(self, out_queue: Queue, fpath: str, fields: Optional[frozenset] = None,
+                 prefilter: Callable[[dict], Optional[object]] = None,
+                 prescreen: Callable[[bytes], bool] = None, raw: bool = False):
+        super(JsonlFileReader, self).__init__(out_queue, fpath)
+        self.fields = fields
+        self.prefilter = prefilter
+        self.prescreen = prescreen
+        # forward lines as unparsed bytes, for writers that pass them through
+        self.raw = raw
+
+    def forward_line(self, line):
+        if (self.prescreen is not None) and not self.prescreen(line):
+            return
+        if self.raw:
+            self.forward_item(line.rstrip(b'\r\n'))
+            return
+        item = parse_line(line, self.fields, self.prefilter)
+        if item is not None:
+            self.forward_item(item)
+
     def read(self, **args):
-        with open(self.fpath) as f:
+        with open_sequential(self.fpath) as f:
             for line in f:
                 if (line is not None) and len(line.strip()):
-                    self.forward_item(json.loads(line))
+                    try:
+                        self.forward_line(line)
+                    except orjson.JSONDecodeError as e:
+                        print(f"error in {self.fpath}")
+                        print(e)
 
 
 class ZstdFileChunkReader(JsonlFileReader):
+    batch_size = 1  # chunks are large enough on their own
+
     def read(self, **args):
         print(f"reading {self.fpath}")
-        with open(self.fpath, 'rb') as fh:
-            for chunk in decompress_by_chunk(fh):
+        with open_sequential(self.fpath) as fh:
+            # named blocks vanish with their last handle on windows, so
+            # chunks are only shared on posix
+            chunks = decompress_to_shared(fh) if os.name == 'posix' \
+                else decompress_by_chunk(fh)
+            for chunk in chunks:
                 self.forward_item(chunk)
 
 
 class ZstdFileReader(JsonlFileReader):
     def read(self, **args):
         print(f"reading {self.fpath}")
-        with open(self.fpath, 'rb') as fh:
+        with open_sequential(self.fpath) as fh:
             for line in decompress(fh):
                 try:
-                    self.forward_item(json.loads(line))
-                except JSONDecodeError as e:
+                    self.forward_line(line)
+                except orjson.JSONDecodeError as e:
                     print(f"error in {self.fpath}")
                     print(e)
 
 
-def zstd_read(args):
-    fpath, q = args
+# (queue, fields, prefilter, prescreen, batch_size, raw), set in each pool worker
+# by `init_read_context`
+_READ_CONTEXT = None
+
+
+def init_read_context(*context):
+    # queues can't be pickled into tasks, but pool workers inherit them; the
+    # other settings come along so they are unpickled once, not once per file
+    global _READ_CONTEXT
+    _READ_CONTEXT = context
+
+
+def zstd_read(fpath):
+    q, fields, prefilter, prescreen, batch_size, raw = _READ_CONTEXT
     print(f'processing {fpath}')
-    with open(fpath, 'rb') as fh:
-        for line in decompress(fh):
-            try:
-                q.put(json.loads(line))
-            except JSONDecodeError as e:
-                print(f"error in {fpath}")
-                print(e)
+    batch = []
+    try:
+        with open_sequential(fpath) as fh:
+            for line in decompress(fh):
+                if (prescreen is not None) and not prescreen(line):
+                    continue
+                try:
+                    item = line if raw else parse_line(line, fields, prefilter)
+                    if item is not None:
+                        batch.append(item)
+                except orjson.JSONDecodeError as e:
+                    print(f"error in {fpath}")
+                    print(e)
+                if len(batch) >= batch_size:
+                    q.put(batch)
+                    batch = []
+    finally:  # what was read so far still goes out if reading fails
+        if batch:
+            q.put(batch)
 
 
 class ZstdFileParallelReader(ZstdFileReader):
     def __init__(self, out_queue: Queue, fpaths: list[str], nthreads: int = 10,
-                 fpath: str = None):
-        super(ZstdFileParallelReader, self).__init__(out_queue, fpath)
+                 fpath: str = None, fields: Optional[frozenset] = None,
+                 prefilter: Callable[[dict], Optional[object]] = None,
+                 prescreen: Callable[[bytes], bool] = None, raw: bool = False):
+        super(ZstdFileParallelReader, self).__init__(out_queue, fpath, fields=fields,
+                                                     prefilter=prefilter,
+                                                     prescreen=prescreen, raw=raw)
         self.fpaths = fpaths
         self.nthreads = nthreads
 
     def read(self, **args):
-        with Pool(self.nthreads) as pool:
-            args = [(fpath, self.out_queue) for fpath in self.fpaths]
-            _ = pool.map(zstd_read, args)
+        context = (self.out_queue, self.fields, self.prefilter, self.prescreen,
+                   self.batch_size, self.raw)
+        with Pool(self.nthreads, initializer=init_read_context,
+                  initargs=context) as pool:
+            for _ in pool.imap_unordered(zstd_read, self.fpaths, chunksize=1):
+                pass
+            # let workers exit on their own so their queue feeders flush;
+            # leaving the block terminates them and may lose queued batches
+            pool.close()
+            pool.join()
+
+
+def zstd_extract(args):
+    fpath, fout, func, prescreen = args
+    print(f'extracting {fpath} to {fout}')
+    with open_sequential(fpath) as fh, \
+            open(fout, 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+        for line in decompress(fh):
+            if (prescreen is not None) and not prescreen(line):
+                continue
+            try:
+                item = orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                print(f"error in {fpath}")
+                print(e)
+                continue
+            if func is not None:
+                item = func(item)
+                if item is None:
+                    continue
+            if not isinstance(item, bytes):
+                item = orjson.dumps(item)
+            out.write(item + b'\n')
+    return fout
+
+
+def extract_files(fpaths: list[str], fout: str,
+                  func: Callable[[dict], Optional[object]] = None,
+                  prescreen: Callable[[bytes], bool] = None,
+                  nthreads: int = 10):
+    """ Filters zst files in parallel without queues: each worker parses a file
+    and writes its own part, and the parts are then appended to `fout` """
+    parts = [f'{fout}.part{i}' for i in range(len(fpaths))]
+    with Pool(nthreads) as pool:
+        args = [(fpath, part, func, prescreen)
+                for fpath, part in zip(fpaths, parts)]
+        _ = pool.map(zstd_extract, args)
+    with open(fout, 'ab') as out:
+        for part in parts:
+            with open_sequential(part) as f:
+                shutil.copyfileobj(f, out, WRITE_BUFFER_SIZE)
+            os.remove(part)
+
+
+class PipeSender:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def put(self, item):
+        self.conn.send(item)
+
+    def close(self):  # ends the stream; PipeChannel counts these
+        self.conn.send(SENTINEL)
+        self.conn.close()
+
+
+class PipeChannel:
+    """ One-way pipes from each producer to a single consumer, with the part
+    of the Queue interface that writers use
+
+    Items of one producer come out in the order they were sent, but there's
+    no order between producers: `get` serves the pipes that are ready in
+    turn, in the order of `senders`, so the coordinator's pipe goes last.
+
+    SENTINEL comes out once every producer closed its sender, or once the
+    coordinator sent one (see `put`) and what producers had sent is taken.
+    """
+
+    def __init__(self, n_producers: int):
+        # the extra pipe is for the process coordinating the workers
+        pipes = [Pipe(duplex=False) for _ in range(n_producers + 1)]
+        self.receivers = [receiver for receiver, _ in pipes]
+        self.senders = [PipeSender(sender) for _, sender in pipes]
+        self._ready = deque()
+        self._open = self.receivers[:-1]  # producers that may send more
+        self._stopping = False
+
+    def put(self, item):
+        # the coordinator sends SENTINEL only once producers have finished
+        self.senders[-1].put(item)
+
+    def get(self, timeout: Optional[float] = None):
+        while True:
+            if not self._ready:
+                if self._stopping or not self._open:
+                    # nothing more is coming: take what's left, don't wait
+                    ready = wait(self._open, timeout=0) if self._open else []
+                    if not ready:
+                        return SENTINEL
+                else:
+                    ready = wait(self._open + self.receivers[-1:],
+                                 timeout=timeout)
+                    if not ready:
+                        raise queue.Empty
+                # wait() gives no order of its own
+                self._ready = deque(r for r in self.receivers if r in ready)
+            receiver = self._ready.popleft()
+            item = receiver.recv()
+            if item is not SENTINEL:
+                return item
+            if receiver is self.receivers[-1]:
+                self._stopping = True
+            else:
+                self._open = [r for r in self._open if r is not receiver]
+
+
+class RoundRobinQueue:
+    """ A bounded queue per consumer, filled in turn by each producer, with
+    the part of the Queue interface that readers use """
+
+    def __init__(self, n_consumers: int, maxsize: int = 0):
+        self.queues = [Queue(maxsize=maxsize) for _ in range(n_consumers)]
+        self._next = 0  # each producer process rotates on its own copy
+
+    def put(self, item):
+        self.queues[self._next].put(item)
+        self._next = (self._next + 1) % len(self.queues)
+
+    def close(self):  # like Queue.close: this process puts nothing more
+        for q in self.queues:
+            q.close()
+
+
+class SharedRingQueue:
+    """ A bounded queue of byte strings in a shared memory ring
+
+    Messages are copied in and out of the ring without pickling or pipes;
+    `put` and `get` pickle other objects, for the Queue interface. The ring
+    keeps the total bytes ever read (head) and written (tail), so it is empty
+    at head == tail and full when tail - head reaches its size.
+
+    The lock only guards the indices and each message's header: producers
+    reserve their space under it, copy their message in without it, then
+    mark the message ready, so large messages are written concurrently.
+    """
+    cache_line = 128  # spans adjacent-line prefetching too
+    # consumers write head, producers tail: each gets its own cache line so
+    # neither side invalidates the other's
+    head_at, tail_at, data_at = 0, cache_line, 2 * cache_line
+    counter = struct.Struct('<Q')
+    header = struct.Struct('<II')  # (message length, ready)
+    # messages are padded to whole headers, so a header never wraps around
+    align = header.size
+
+    def __init__(self, size: int = 2 ** 26):
+        if size % self.align:
+            raise ValueError(f'ring size must be a multiple of {self.align}')
+        self.size = size
+        self.shm = SharedMemory(create=True, size=self.data_at + size)
+        self.counter.pack_into(self.shm.buf, self.head_at, 0)
+        self.counter.pack_into(self.shm.buf, self.tail_at, 0)
+        lock = Lock()
+        self.not_empty = Condition(lock)
+        self.not_full = Condition(lock)
+        # producers' last look at head; it only grows, so the space it implies
+        # is a safe lower bound and head is only re-read when that runs out
+        self._head = 0
+        # consumers' last look at tail, the same way: messages up to it are
+        # there to be taken without re-reading tail
+        self._tail = 0
+
+    def _load(self, at):
+        return self.counter.unpack_from(self.shm.buf, at)[0]
+
+    def _store(self, at, value):
+        self.counter.pack_into(self.shm.buf, at, value)
+
+    def _copy_in(self, pos, data):
+        start = self.data_at + pos % self.size
+        first = min(len(data), self.data_at + self.size - start)
+        self.shm.buf[start:start + first] = data[:first]
+        rest = len(data) - first
+        if rest:  # wrapped around
+            self.shm.buf[self.data_at:self.data_at + rest] = data[first:]
+
+    def _copy_out(self, pos, n):
+        start = self.data_at + pos % self.size
+        first = min(n, self.data_at + self.size - start)
+        data = bytes(self.shm.buf[start:start + first])
+        if first < n:
+            data += bytes(self.shm.buf[self.data_at:self.data_at + n - first])
+        return data
+
+    def _span(self, n):  # ring bytes taken by a message of n bytes
+        return self.header.size + -(-n // self.align) * self.align
+
+    def _ready(self, pos):
+        return self.header.unpack_from(self.shm.buf, self.data_at + pos % self.size)[1]
+
+    def put_bytes(self, data: bytes):
+        n = self._span(len(data))
+        if n > self.size:
+            raise ValueError(f'message of {len(data)} bytes does not fit the ring')
+        with self.not_full:
+            tail = self._load(self.tail_at)
+            while self.size - (tail - self._head) < n:
+                self._head = self._load(self.head_at)
+                if self.size - (tail - self._head) >= n:
+                    break
+                self.not_full.wait()
+                tail = self._load(self.tail_at)  # other producers went first
+            self.header.pack_into(self.shm.buf, self.data_at + tail % self.size,
+                                  len(data), 0)
+            self._store(self.tail_at, tail + n)
+        # the space is ours until the consumer passes it, which it won't
+        # before the message is marked ready
+        self._copy_in(tail + self.header.size, data)
+        with self.not_empty:
+            self.header.pack_into(self.shm.buf, self.data_at + tail % self.size,
+                                  len(data), 1)
+            # messages are taken in order, so consumers may be waiting on
+            # this one even when later ones are ready
+            self.not_empty.notify_all()
+
+    def get_bytes(self) -> bytes:
+        with self.not_empty:
+            while True:
+                # re-read after waiting: other consumers may have moved it
+                head = self._load(self.head_at)
+                if head >= self._tail:
+                    self._tail = self._load(self.tail_at)
+                if (head < self._tail) and self._ready(head):
+                    break
+                self.not_empty.wait()
+            n, _ = self.header.unpack_from(self.shm.buf,
+                                           self.data_at + head % self.size)
+            data = self._copy_out(head + self.header.size, n)
+            self._store(self.head_at, head + self._span(n))
+            # space freed may be what any of the waiting producers needs
+            self.not_full.notify_all()
+        return data
+
+    def put(self, item):
+        self.put_bytes(pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def get(self):
+        return pickle.loads(self.get_bytes())
+
+    def close(self):  # like Queue.close: this process uses the ring no more
+        self.shm.close()
+
+    def unlink(self):  # by the process that created the ring, once all are done
+        self.shm.unlink()
+
+
+class SharedRingLines(SharedRingQueue):
+    """ A SharedRingQueue for batches of byte lines, e.g. serialized records
+
+    Each batch travels as newline-joined bytes, with no pickling; lines must
+    not contain newlines themselves. Batches too large for the ring are
+    split, so only a single line larger than the ring fails.
+    """
+
+    def put(self, batch):
+        # an empty message is the sentinel; batches are wrapped in newlines,
+        # so empty batches and batches of empty lines are told apart too
+        if batch is SENTINEL:
+            self.put_bytes(b'')
+            return
+        data = b'\n'.join([b'', *batch, b''])
+        if (self._span(len(data)) > self.size) and (len(batch) > 1):
+            # too large for the ring as a whole, so sent in halves
+            half = len(batch) // 2
+            self.put(batch[:half])
+            self.put(batch[half:])
+            return
+        self.put_bytes(data)
+
+    def get(self):
+        data = self.get_bytes()
+        return data.split(b'\n')[1:-1] if data else SENTINEL
 
 
 class Writer(Process, ABC):
+    progress = False  # show a progress bar of written items
+
     def __init__(self, in_queue: Queue, fpath: str):
         super(Writer, self).__init__()
-        self.stop_event = Event()
         self.fpath = fpath
         self.in_queue = in_queue
 
@@ -174,27 +692,15 @@ class Writer(Process, ABC):
         pass
 
     def collect_items(self):
-        done = False
-        while not done:
-            try:
-                item = self.in_queue.get(timeout=1)
-                self.write(item)
-            except queue.Empty as e:  # queue closed or timeout in get
-                if self.stop_event.is_set():
-                    done = True
-                else:
-                    pass
-        # with tqdm() as pbar:
-        #     while not done:
-        #         try:
-        #             item = self.in_queue.get(timeout=1)
-        #             self.write(item)
-        #             pbar.update(1)
-        #         except queue.Empty as e:  # queue closed or timeout in get
-        #             if self.stop_event.is_set():
-        #                 done = True
-        #             else:
-        #                 pass
+        # updated once per batch; per-item updates cost a lock each
+        with tqdm(disable=not self.progress, mininterval=1.0) as pbar:
+            for batch in iter(self.in_queue.get, SENTINEL):
+                self.write_batch(batch)
+                pbar.update(len(batch))
+
+    def write_batch(self, batch):
+        for item in batch:
+            self.write(item)
 
     def run(self):
         self.collect_items()
@@ -202,7 +708,7 @@ class Writer(Process, ABC):
         self.close()
 
     def stop(self):  # signal the writer that upstream processing finished
-        self.stop_event.set()
+        self.in_queue.put(SENTINEL)
 
 
 class DummyWriter(Writer):
@@ -220,9 +726,16 @@ class LineFileWriter(Writer):
         self.fhandle = None
 
     def write(self, item, **args):
+        self.write_line(item + b'\n')
+
+    def write_batch(self, batch):  # one buffered write per batch
+        if batch:
+            self.write_line(b'\n'.join(batch) + b'\n')
+
+    def write_line(self, line: bytes):
         if self.fhandle is None:
-            self.fhandle = open(self.fpath, 'a+', encoding='utf8')
-        self.fhandle.write(item + '\n')
+            self.fhandle = open(self.fpath, 'ab', buffering=WRITE_BUFFER_SIZE)
+        self.fhandle.write(line)
 
     def close_writer(self):
         print('closing writer')
@@ -232,33 +745,76 @@ class LineFileWriter(Writer):
 
 
 class JsonlFileWriter(LineFileWriter):
+    sort_keys = False  # sorting costs per record, and jsonl readers don't care
+
+    def dumps(self, item):  # newline included, saving a concatenation
+        if isinstance(item, bytes):  # raw lines are written as they were read
+            return item + b'\n'
+        option = orjson.OPT_APPEND_NEWLINE
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(item, option=option)
 
     def write(self, item, **args):
-        super(JsonlFileWriter, self).write(json.dumps(item, sort_keys=True))
+        self.write_line(self.dumps(item))
+
+    def write_batch(self, batch):
+        self.write_line(b''.join(map(self.dumps, batch)))
 
 
 class MultiJsonlFileWriter(JsonlFileWriter):
     def __init__(self, in_queue: Queue, fpaths_func: Callable[[dict], str],
-                 fpath: str = None):
+                 fpath: str = None, fpaths_key: str = None):
         super(MultiJsonlFileWriter, self).__init__(in_queue, fpath)
         # self.stop_event = Event()
         self.fpaths_func = fpaths_func
+        # if `fpaths_func` only depends on item[fpaths_key], its results are
+        # cached by that value
+        self.fpaths_key = fpaths_key
+        self.fpaths_cache = dict()
         # self.multiple_writes_per_item = multiple_writes_per_item
         # self.fhandles = {k: open(k, 'a+', encoding="utf8") for k in self.fpaths_and_filters}
         self.fhandles = dict()
+        self.fhandles_cache = dict()  # like fpaths_cache, for open handles
         # self.in_queue = in_queue
 
     def open(self, fpath):
         if fpath not in self.fhandles:
             print(fpath)
-            self.fhandles[fpath] = open(fpath, 'a+', encoding="utf8")
+            self.fhandles[fpath] = open(fpath, 'ab',
+                                        buffering=MULTI_WRITE_BUFFER_SIZE)
         self.fhandle = self.fhandles[fpath]
 
-    def write(self, item, **args):
-        fpaths = self.fpaths_func(item)
-        for fpath in fpaths:
+    def get_fpaths(self, item):
+        if self.fpaths_key is None:
+            return self.fpaths_func(item)
+        key = item.get(self.fpaths_key)
+        if key not in self.fpaths_cache:
+            self.fpaths_cache[key] = self.fpaths_func(item)
+        return self.fpaths_cache[key]
+
+    def get_fhandles(self, item):
+        if self.fpaths_key is not None:
+            key = item.get(self.fpaths_key)
+            if key in self.fhandles_cache:
+                return self.fhandles_cache[key]
+        fhandles = []
+        for fpath in self.get_fpaths(item):
             self.open(fpath)
-            super(MultiJsonlFileWriter, self).write(item)
+            fhandles.append(self.fhandle)
+        if self.fpaths_key is not None:
+            self.fhandles_cache[key] = fhandles
+        return fhandles
+
+    def write_batch(self, batch):  # items of a batch go to different files
+        Writer.write_batch(self, batch)
+
+    def write(self, item, **args):
+        line = self.dumps(item)
+        if isinstance(item, bytes):  # only parsed to pick its files
+            item = orjson.loads(item)
+        for fh in self.get_fhandles(item):
+            fh.write(line)
 
     def close_writer(self):
         for fh in self.fhandles.values():
@@ -266,12 +822,59 @@ class MultiJsonlFileWriter(JsonlFileWriter):
 
 
 class MultiGzipJsonFileWriter(MultiJsonlFileWriter):
+    compresslevel = 1  # much faster than the default 9, for a small size cost
+
     def open(self, fpath):
         if fpath not in self.fhandles:
-            self.fhandles[fpath] = gzip.open(fpath, 'wt+', encoding="utf8")
+            # small writes are costly for GzipFile, so buffer in front of it
+            self.fhandles[fpath] = io.BufferedWriter(
+                GzipFile(fpath, 'ab', compresslevel=self.compresslevel, mtime=0),
+                buffer_size=MULTI_WRITE_BUFFER_SIZE)
         self.fhandle = self.fhandles[fpath]
 
 
+class MultiZstdJsonlFileWriter(MultiJsonlFileWriter):
+    level = 3
+
+    def __init__(self, in_queue: Queue, fpaths_func: Callable[[dict], str],
+                 fpath: str = None, fpaths_key: str = None,
+                 dict_data: zstd.ZstdCompressionDict = None):
+        super(MultiZstdJsonlFileWriter, self).__init__(
+            in_queue, fpaths_func, fpath=fpath, fpaths_key=fpaths_key)
+        # a dictionary trained on sample records helps a lot on short lines
+        self.dict_data = dict_data
+
+    def open(self, fpath):
+        if fpath not in self.fhandles:
+            # a compressor holds the state of one stream, so one per file
+            cctx = zstd.ZstdCompressor(level=self.level,
+                                       dict_data=self.dict_data)
+            self.fhandles[fpath] = cctx.stream_writer(open(fpath, 'ab'))
+        self.fhandle = self.fhandles[fpath]
+
+
+def run_threaded(readers: list[Reader], writer: Writer):
+    """ Runs `readers` in threads and `writer` in the calling thread
+
+    They should share a `queue.Queue`, so items are handed over without any
+    pickling or copying. Worth it for a few files, as zstd decompression
+    releases the GIL; with parsing as the bottleneck, processes scale better.
+    """
+    threads = [threading.Thread(target=reader.run) for reader in readers]
+    for thread in threads:
+        thread.start()
+
+    def stop_writer():
+        for thread in threads:
+            thread.join()
+        writer.stop()
+
+    stopper = threading.Thread(target=stop_writer, daemon=True)
+    stopper.start()
+    writer.run()
+    stopper.join()
+
+
 def fout_func(item):
     return [f"RC_subreddit\\RC_{item['subreddit']}.jsonl.gz"]
 
@@ -313,8 +916,9 @@ def main():
     fin = 'C:\\Users\\matti\\Downloads\\reddit\\comments\\RC_2006-12.zst'
     os.makedirs('RC_subreddit', exist_ok=True)
     q = Queue()
-    reader = ZstdFileReader(out_queue=q, fpath=fin)
-    wp = MultiGzipJsonFileWriter(in_queue=q, fpaths_func=fout_func)
+    reader = ZstdFileReader(out_queue=q, fpath=fin, raw=True)
+    wp = MultiGzipJsonFileWriter(in_queue=q, fpaths_func=fout_func,
+                                 fpaths_key='subreddit')
     reader.start()
     wp.start()
     reader.join()
@@ -1,5 +1,8 @@
 import datetime
+import io
 import os.path
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import freeze_support, RLock
 from multiprocessing.pool import Pool
 from urllib.parse import urljoin, urlsplit
@@ -7,7 +10,7 @@ from urllib.parse import urljoin, urlsplit
 import requests
 import tqdm
 import urllib3
-from lxml import html
+from lxml import etree
 import re
 
 from requests.exceptions import ChunkedEncodingError
@@ -20,6 +23,10 @@ ARCHIVE_URL_PATTERN = BASE_URL_PATTERN + '{contribution_prefix}_{' \
 
 CONTRIBUTION_TYPES = ('comments', 'submissions')
 CONTRIBUTION_PREFIXES = ('RC', 'RS')
+N_DOWNLOADS = 4  # files downloaded at once
+DATE_RE = re.compile(r'.*(?P<year>\d{4})-(?P<month>\d{2})\.zst')
+LINK_RES = {prefix: re.compile(rf'.*{prefix}_\d{{4}}-\d{{2}}\.zst')
+            for prefix in CONTRIBUTION_PREFIXES}
 
 
 # see https://blog.petrzemek.net/2018/04/22/on-incomplete-http-reads-and-the-requests-library-in-python/
@@ -42,13 +49,17 @@ def extract_archive_links(contribution_type):
         contribution_type)]
     url = BASE_URL_PATTERN.format(contribution_type=contribution_type)
     page = requests.get(url)
-    tree = html.fromstring(page.content)
-    links = tree.xpath('//*[@id="container"]/table/tbody/tr/td[1]/a/@href')
-    links = filter(
-        lambda link: re.match(f'.*{contribution_prefix}_\d\d\d\d-\d\d.zst',
-                              link), links)
-    links = map(lambda link: urljoin(url, link), links)
-    return list(links)
+    link_re = LINK_RES[contribution_prefix]
+    links = []
+    # archive links are told apart by name, so one pass over the anchors
+    # does, with no tree built
+    for _, anchor in etree.iterparse(io.BytesIO(page.content), html=True,
+                                     tag='a'):
+        link = anchor.get('href')
+        if link and link_re.match(link):
+            links.append(urljoin(url, link))
+        anchor.clear()
+    return links
 
 
 def format_url(contribution_type='comments',
@@ -63,41 +74,64 @@ def format_url(contribution_type='comments',
 
 
 def date(url):
-    m = re.match(".*(?P<year>\d{4})-(?P<month>\d{2})\.zst", url)
+    m = DATE_RE.match(url)
     month, year = int(m.group('month')), int(m.group('year'))
     return datetime.date(month=month, year=year, day=1)
 
 
+def make_session(n_connections=N_DOWNLOADS):
+    """ A session keeping up to `n_connections` connections alive for reuse """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=n_connections,
+                                            pool_maxsize=n_connections)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 def stream(url):
     response = requests.get(url, stream=True)
     return response.raw
 
 
-def download(url, store_path, chunk_size=1024 ** 2, overwrite=False, retry_times=3, pid=1):
-    if (not overwrite) and os.path.exists(store_path):
+def download(url, store_path, chunk_size=1024 ** 2, overwrite=False, retry_times=3, pid=1,
+             session=None, resume=False):
+    if (not overwrite) and (not resume) and os.path.exists(store_path):
         print(f'skipping {url} as it already exists in {store_path}. Set `overwrite=True to download anyway.`')
         return
     headers={'User-Agent':"pullshift v0.0.1 by u/hide-ous"}
-    response = requests.get(url, stream=True, headers=headers)
-
-    total_size = int(response.headers['Content-Length'])
+    # with `resume`, only the bytes missing from store_path are requested
+    have = os.path.getsize(store_path) if resume and os.path.exists(store_path) else 0
+    if have:
+        headers['Range'] = f'bytes={have}-'
+    response = (session or requests).get(url, stream=True, headers=headers)
+    if have and response.status_code != 206:  # the range was ignored
+        have = 0
+
+    length = response.headers.get('Content-Length')
+    total_size = have + int(length) if length is not None else None
     # chunk_iterator = tqdm.tqdm(response.iter_content(chunk_size=chunk_size),
     #                            desc="downloading " + url + " to " + store_path,
     #                            total=int(total_size / chunk_size),
     #                            position=pid+1)
+    # archives are compressed already; bytes are kept as sent, which is
+    # also what Range and Content-Length count
+    response.raw.decode_content = False
     try:
-        with open(store_path, "wb+") as out_file:
-            with tqdm.tqdm(desc="downloading " + url + " to " + store_path,
-                           total=int(total_size / chunk_size),
-                           # position=pid
-                           ) as pbar:
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    out_file.write(chunk)
-                    pbar.update(1)
+        with open(store_path, "ab" if have else "wb+") as out_file:
+            # the copy loop runs in C; the bar just counts what raw.read returns
+            with tqdm.tqdm.wrapattr(response.raw, 'read',
+                                    desc="downloading " + url + " to " + store_path,
+                                    total=total_size, initial=have,
+                                    # position=pid
+                                    ) as raw:
+                shutil.copyfileobj(raw, out_file, length=chunk_size)
     except (ChunkedEncodingError, IncompleteRead, ProtocolError) as e:
         print(e)
         if retry_times - 1 > 0:
-            download(url, store_path, chunk_size=chunk_size, overwrite=True, retry_times=retry_times - 1)
+            # picks up where the dropped connection stopped
+            download(url, store_path, chunk_size=chunk_size, retry_times=retry_times - 1,
+                     session=session, resume=True)
         else:
             if os.path.exists(store_path):
                 os.remove(store_path)
@@ -120,13 +154,18 @@ if __name__ == '__main__':
     # max_date = datetime.date(2006, 12, 1)
     max_date = datetime.date(2023, 12, 1)
     base_store_path = 'E:\\pushshift'
-    # urls = []
+    urls = []
     for contribution_type in ['submissions']:
     # for contribution_type in CONTRIBUTION_TYPES:
         for url in filter(lambda url: min_date <= date(url) <= max_date,
                           extract_archive_links(contribution_type)):
-            # urls.append(url)
-            download(url, os.path.join(base_store_path, to_fname(url)))
+            urls.append(url)
+    # files download side by side, over connections kept open between files
+    session = make_session(N_DOWNLOADS)
+    with ThreadPoolExecutor(max_workers=N_DOWNLOADS) as executor:
+        list(executor.map(lambda url: download(url, os.path.join(base_store_path, to_fname(url)),
+                                               session=session),
+                          urls))
     # poo = Pool(processes=3, initargs=(RLock(),), initializer=tqdm.tqdm.set_lock)
     #
     # jobs = [poo.apply_async(download, args=(url,
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""Tests for `pullshift.pushshift_contribution`."""
+
+
+import copy
+import pickle
+import unittest
+from multiprocessing import Queue
+
+import orjson
+
+from pullshift.pushshift_contribution import FieldValuePrescreen, \
+    CompiledPipeline, Pipeline, compile_pipeline, fast_clean_text, \
+    keep_contribution, keep_field_value, keep_fields, normalize_text, \
+    to_string
+from pullshift.pushshift_file import SENTINEL, PipeChannel
+
+
+ITEMS = [
+    {'id': 'c1', 'body': 'Hello r/nasa, 42 rockets!', 'parent_id': 't3_s1',
+     'link_id': 't3_s1', 'subreddit': 'nasa', 'score': 3},
+    {'id': 'c2', 'body': 'off topic', 'parent_id': 't1_c1',
+     'link_id': 't3_s1', 'subreddit': 'science', 'score': 1},
+    {'id': 's1', 'is_self': True, 'title': 'Moon', 'selftext': 'Is it cheese?',
+     'subreddit': 'nasa', 'score': 10},
+    {'id': 's2', 'is_self': False, 'title': 'A link', 'url': 'http://x.y',
+     'subreddit': 'nasa'},
+]
+
+
+def run_stages(funcs, item):
+    """ The stages called one by one, as a reference for the fused code """
+    for func, args in funcs:
+        if item is None:
+            return None
+        item = func(item, **args)
+    return item
+
+
+def loaded(items):
+    # fused code may order keys differently, e.g. sorting `fields` sets
+    return [orjson.loads(item) if isinstance(item, bytes) else item
+            for item in items]
+
+
+class TestFieldValuePrescreen(unittest.TestCase):
+    """Tests for `FieldValuePrescreen`."""
+
+    def setUp(self):
+        self.prescreen = FieldValuePrescreen('subreddit', {'nasa', 'Ünï'})
+
+    def test_plain_values(self):
+        self.assertTrue(self.prescreen(b'{"id":"a","subreddit":"nasa"}'))
+        self.assertTrue(self.prescreen(b'{"subreddit" : "nasa"}'))
+        self.assertFalse(self.prescreen(b'{"id":"a","subreddit":"science"}'))
+        self.assertFalse(self.prescreen(b'{"id":"a"}'))
+
+    def test_escaped_values_pass(self):
+        # orjson writes non-ascii as is, but other writers escape it
+        self.assertTrue(self.prescreen(b'{"subreddit":"\\u00dcn\\u00ef"}'))
+        self.assertTrue(self.prescreen(b'{"subreddit":"a\\"b"}'))
+
+    def test_raw_utf8_values(self):
+        self.assertTrue(self.prescreen(orjson.dumps({'subreddit': 'Ünï'})))
+
+
+class TestCompilePipeline(unittest.TestCase):
+    """Tests for `compile_pipeline`, against the plain stage calls."""
+
+    def check(self, funcs):
+        expected = [run_stages(funcs, copy.deepcopy(item)) for item in ITEMS]
+        fused = compile_pipeline(funcs)
+        self.assertEqual(loaded(fused(copy.deepcopy(item)) for item in ITEMS),
+                         loaded(expected))
+        pipeline = Pipeline(None, None, funcs)
+        self.assertEqual(loaded(pipeline.process_batch(copy.deepcopy(ITEMS))),
+                         loaded(item for item in expected if item is not None))
+
+    def test_inlined_stages(self):
+        self.check([
+            (keep_field_value, dict(field='subreddit', values={'nasa'})),
+            (keep_contribution, dict(fields_and_values={'subreddit': {'nasa'}})),
+            (normalize_text, dict()),
+            (keep_fields, dict(fields=('fullname', 'subreddit', 'text'))),
+        ])
+
+    def test_called_stages(self):
+        self.check([
+            (normalize_text, dict()),
+            (fast_clean_text, dict(remove_digit=False)),
+            (keep_fields, dict(fields={'fullname', 'text', 'contribution_type'})),
+            (to_string, dict()),
+        ])
+
+    def test_key_order(self):
+        fields = ('text', 'fullname', 'subreddit')
+        fused = compile_pipeline([(normalize_text, dict()),
+                                  (keep_fields, dict(fields=fields))])
+        self.assertEqual(tuple(fused(copy.deepcopy(ITEMS[0]))), fields)
+
+    def test_empty(self):
+        self.assertEqual(compile_pipeline([])(ITEMS[0]), ITEMS[0])
+
+    def test_pickles(self):
+        funcs = [(keep_field_value, dict(field='subreddit', values={'nasa'})),
+                 (to_string, dict())]
+        pipeline = pickle.loads(pickle.dumps(CompiledPipeline(funcs)))
+        self.assertEqual([pipeline(copy.deepcopy(item)) for item in ITEMS],
+                         [run_stages(funcs, copy.deepcopy(item))
+                          for item in ITEMS])
+
+
+class TestProcessorEndOfStream(unittest.TestCase):
+    """Tests for processors ending their output streams."""
+
+    funcs = [(keep_field_value, dict(field='subreddit', values={'nasa'}))]
+
+    def run_processors(self, qout, senders):
+        qins = [Queue() for _ in senders]
+        processors = [Pipeline(qin, sender, self.funcs)
+                      for qin, sender in zip(qins, senders)]
+        for processor in processors:
+            processor.start()
+        for qin in qins:
+            qin.put(copy.deepcopy(ITEMS))
+        for processor in processors:
+            processor.stop()
+        got = [item['id'] for batch in iter(qout.get, SENTINEL)
+               for item in batch]
+        for processor in processors:
+            processor.join()
+        return sorted(got)
+
+    def test_pipe_channel(self):
+        # no coordinator sentinel: the processors' own end the channel
+        channel = PipeChannel(2)
+        self.assertEqual(self.run_processors(channel, channel.senders[:-1]),
+                         sorted(['c1', 's1', 's2'] * 2))
+
+    def test_queue(self):
+        # closing a plain queue ends nothing, but mustn't fail either
+        qin, qout = Queue(), Queue()
+        processor = Pipeline(qin, qout, self.funcs)
+        processor.start()
+        qin.put(copy.deepcopy(ITEMS))
+        processor.stop()
+        got = [item['id'] for item in qout.get(timeout=10)]
+        processor.join()
+        self.assertEqual(processor.exitcode, 0)
+        self.assertEqual(sorted(got), ['c1', 's1', 's2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""Tests for `pullshift.pushshift_file`."""
+
+
+import io
+import queue
+import random
+import unittest
+from multiprocessing import Process, Queue
+
+import zstandard
+
+from pullshift.pushshift_file import SENTINEL, PipeChannel, RoundRobinQueue, \
+    SharedRingLines, SharedRingQueue, decompress
+
+
+def send_all(sender, k):
+    for i in range(100):
+        sender.put([(k, i)])
+    sender.close()
+
+
+def ring_message(k, i):
+    # sizes vary, so messages end anywhere and often wrap around the ring
+    return b'%d:%d:' % (k, i) + bytes([i % 256]) * ((i * 37) % 900)
+
+
+def ring_produce(ring, k, n):
+    for i in range(n):
+        ring.put_bytes(ring_message(k, i))
+
+
+def ring_consume(ring, out):
+    got = []
+    for message in iter(ring.get_bytes, b''):
+        k, i, _ = message.split(b':', 2)
+        got.append((int(k), int(i), message == ring_message(int(k), int(i))))
+    out.put(got)
+
+
+class TestPipeChannel(unittest.TestCase):
+    """Tests for `PipeChannel`."""
+
+    def test_put_get(self):
+        channel = PipeChannel(3)
+        for i, sender in enumerate(channel.senders[:-1]):
+            sender.put([i])
+        self.assertEqual(sorted(channel.get(timeout=1) for _ in range(3)),
+                         [[0], [1], [2]])
+
+    def test_order_within_producer(self):
+        channel = PipeChannel(2)
+        for i in range(5):
+            channel.senders[0].put([b'a', i])
+            channel.senders[1].put([b'b', i])
+        got = [channel.get(timeout=1) for _ in range(10)]
+        for name in (b'a', b'b'):
+            self.assertEqual([i for n, i in got if n == name], list(range(5)))
+
+    def test_ready_pipes_in_order(self):
+        channel = PipeChannel(2)
+        channel.senders[1].put([b'b'])
+        channel.senders[0].put([b'a'])
+        self.assertEqual(channel.get(timeout=1), [b'a'])
+        self.assertEqual(channel.get(timeout=1), [b'b'])
+
+    def test_coordinator(self):
+        channel = PipeChannel(1)
+        channel.put(SENTINEL)
+        self.assertIs(channel.get(timeout=1), SENTINEL)
+
+    def test_coordinator_sentinel_drains_producers(self):
+        channel = PipeChannel(2)
+        channel.senders[0].put([b'a'])
+        channel.senders[1].put([b'b'])
+        channel.senders[1].put([b'c'])
+        channel.put(SENTINEL)
+        self.assertEqual(sorted(iter(channel.get, SENTINEL)),
+                         [[b'a'], [b'b'], [b'c']])
+
+    def test_producer_sentinels(self):
+        channel = PipeChannel(2)
+        channel.senders[0].put([b'a'])
+        channel.senders[0].close()
+        channel.senders[1].put([b'b'])
+        self.assertEqual(channel.get(timeout=1), [b'a'])
+        self.assertEqual(channel.get(timeout=1), [b'b'])
+        with self.assertRaises(queue.Empty):  # the second one isn't done
+            channel.get(timeout=.1)
+        channel.senders[1].close()
+        self.assertIs(channel.get(timeout=1), SENTINEL)
+
+    def test_across_processes(self):
+        channel = PipeChannel(3)
+        producers = [Process(target=send_all, args=(sender, k))
+                     for k, sender in enumerate(channel.senders[:-1])]
+        for producer in producers:
+            producer.start()
+        got = [item for batch in iter(channel.get, SENTINEL) for item in batch]
+        for producer in producers:
+            producer.join()
+        self.assertEqual(sorted(got),
+                         sorted((k, i) for k in range(3) for i in range(100)))
+
+
+class TestRoundRobinQueue(unittest.TestCase):
+    """Tests for `RoundRobinQueue`."""
+
+    def test_rotates(self):
+        rr = RoundRobinQueue(3)
+        for i in range(7):
+            rr.put(i)
+        self.assertEqual([rr.queues[0].get(timeout=1) for _ in range(3)],
+                         [0, 3, 6])
+        self.assertEqual([rr.queues[1].get(timeout=1) for _ in range(2)],
+                         [1, 4])
+        self.assertEqual([rr.queues[2].get(timeout=1) for _ in range(2)],
+                         [2, 5])
+        for q in rr.queues:
+            self.assertTrue(q.empty())
+
+
+class TestSharedRingQueue(unittest.TestCase):
+    """Tests for `SharedRingQueue`."""
+
+    def setUp(self):
+        self.ring = SharedRingQueue(2 ** 12)
+
+    def tearDown(self):
+        self.ring.close()
+        self.ring.unlink()
+
+    def test_put_get(self):
+        for message in (b'', b'a', b'bc' * 100, {'not': 'bytes'}):
+            if isinstance(message, bytes):
+                self.ring.put_bytes(message)
+                self.assertEqual(self.ring.get_bytes(), message)
+            else:
+                self.ring.put(message)
+                self.assertEqual(self.ring.get(), message)
+
+    def test_wraps_around(self):
+        rnd = random.Random(0)
+        messages = [bytes([i % 256]) * rnd.randint(0, 1500)
+                    for i in range(200)]
+        pending = []
+        for message in messages:  # keep the ring partly full throughout
+            self.ring.put_bytes(message)
+            pending.append(message)
+            if len(pending) > 1:
+                self.assertEqual(self.ring.get_bytes(), pending.pop(0))
+        for message in pending:
+            self.assertEqual(self.ring.get_bytes(), message)
+        self.assertGreater(self.ring._load(self.ring.tail_at),
+                           10 * self.ring.size)
+
+    def test_too_large(self):
+        with self.assertRaises(ValueError):
+            self.ring.put_bytes(b'x' * self.ring.size)
+        with self.assertRaises(ValueError):
+            SharedRingQueue(1001)
+
+    def stress(self, n_producers, n_consumers, n=2000):
+        out = Queue()
+        producers = [Process(target=ring_produce, args=(self.ring, k, n))
+                     for k in range(n_producers)]
+        consumers = [Process(target=ring_consume, args=(self.ring, out))
+                     for _ in range(n_consumers)]
+        for process in producers + consumers:
+            process.start()
+        for producer in producers:
+            producer.join()
+        for _ in consumers:
+            self.ring.put_bytes(b'')
+        got = [message for _ in consumers for message in out.get(timeout=60)]
+        for consumer in consumers:
+            consumer.join()
+        self.assertTrue(all(intact for _, _, intact in got))
+        self.assertEqual(sorted((k, i) for k, i, _ in got),
+                         [(k, i) for k in range(n_producers) for i in range(n)])
+        # each producer's messages are taken in the order they were put
+        for k in range(n_producers):
+            if n_consumers == 1:
+                self.assertEqual([i for k_, i, _ in got if k_ == k],
+                                 list(range(n)))
+
+    def test_many_producers(self):
+        self.stress(3, 1)
+
+    def test_many_consumers(self):
+        self.stress(1, 3)
+
+    def test_many_producers_and_consumers(self):
+        self.stress(3, 3)
+
+
+class TestSharedRingLines(unittest.TestCase):
+    """Tests for `SharedRingLines`."""
+
+    def setUp(self):
+        self.ring = SharedRingLines(2 ** 12)
+
+    def tearDown(self):
+        self.ring.close()
+        self.ring.unlink()
+
+    def test_batches(self):
+        for batch in ([b'a'], [b'a', b'bc', b''], [b''], [b'', b''], []):
+            self.ring.put(batch)
+            self.assertEqual(self.ring.get(), batch)
+
+    def test_batch_larger_than_ring(self):
+        batch = [b'%04d' % i + b'x' * 96 for i in range(200)]
+        self.ring.put(batch)
+        self.ring.put(SENTINEL)
+        self.assertEqual([line for part in iter(self.ring.get, SENTINEL)
+                          for line in part], batch)
+
+    def test_sentinel(self):
+        self.ring.put([b''])
+        self.ring.put(SENTINEL)
+        self.assertEqual(self.ring.get(), [b''])
+        self.assertIs(self.ring.get(), SENTINEL)
+
+
+class TestDecompress(unittest.TestCase):
+    """Tests for `decompress`."""
+
+    def setUp(self):
+        self.lines = [b'{"i":%d,"x":"%s"}' % (i, b'y' * (i % 300))
+                      for i in range(20000)]
+        cctx = zstandard.ZstdCompressor()
+        # several frames, as written by streaming compressors
+        self.data = b''.join(
+            cctx.compress(b'\n'.join(self.lines[i:i + 3000]) + b'\n')
+            for i in range(0, len(self.lines), 3000))
+
+    def test_lines(self):
+        for ahead in (0, 2):
+            lines = decompress(io.BytesIO(self.data), ahead=ahead)
+            self.assertEqual(list(lines), self.lines)
+
+    def test_interleaved_streams(self):
+        # streams open side by side in one thread don't share a decompressor
+        other = [line + b'!' for line in self.lines]
+        data = zstandard.ZstdCompressor().compress(b'\n'.join(other))
+        for ahead in (0, 2):
+            pairs = zip(decompress(io.BytesIO(self.data), ahead=ahead),
+                        decompress(io.BytesIO(data), ahead=ahead))
+            self.assertEqual(list(pairs), list(zip(self.lines, other)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""Tests for `pullshift.pushshift_pages`."""
+
+
+import io
+import os
+import tempfile
+import unittest
+
+from urllib3.exceptions import ProtocolError
+
+from pullshift.pushshift_pages import download
+
+DATA = bytes(range(256)) * 20000
+
+
+class FakeRaw(io.BytesIO):
+    """ A response body that drops the connection after `fail_at` bytes """
+
+    def __init__(self, data, fail_at=None):
+        super(FakeRaw, self).__init__(data)
+        self.fail_at = fail_at
+        self.decode_content = None
+
+    def read(self, n=-1):
+        if (self.fail_at is not None) and (self.tell() >= self.fail_at):
+            raise ProtocolError('connection dropped')
+        return super(FakeRaw, self).read(n)
+
+
+class FakeResponse:
+    def __init__(self, status_code, data, fail_at=None, length=True):
+        self.status_code = status_code
+        self.headers = {'Content-Length': str(len(data))} if length else {}
+        self.raw = FakeRaw(data, fail_at)
+
+
+class FakeSession:
+    """ Serves DATA, dropping the first response halfway through """
+
+    def __init__(self, honor_range=True, length=True):
+        self.honor_range = honor_range
+        self.length = length
+        self.ranges = []
+        self.responses = []
+
+    def get(self, url, stream=False, headers=None):
+        self.ranges.append(headers.get('Range'))
+        fail_at = len(DATA) // 2 if len(self.ranges) == 1 else None
+        if self.honor_range and headers.get('Range'):
+            start = int(headers['Range'][len('bytes='):-1])
+            response = FakeResponse(206, DATA[start:], length=self.length)
+        else:
+            response = FakeResponse(200, DATA, fail_at, length=self.length)
+        self.responses.append(response)
+        return response
+
+
+class TestDownload(unittest.TestCase):
+    """Tests for `download`."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store_path = os.path.join(self.tmpdir.name, 'RC_2005-12.zst')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def download(self, session):
+        download('https://example.org/RC_2005-12.zst', self.store_path,
+                 chunk_size=2 ** 16, session=session)
+        with open(self.store_path, 'rb') as f:
+            return f.read()
+
+    def test_resumes_with_range(self):
+        session = FakeSession()
+        self.assertEqual(self.download(session), DATA)
+        self.assertEqual(session.ranges[0], None)
+        self.assertTrue(session.ranges[1].startswith('bytes='))
+        # bytes are stored as sent, so sizes on disk match the wire
+        self.assertTrue(all(response.raw.decode_content is False
+                            for response in session.responses))
+
+    def test_range_ignored(self):
+        session = FakeSession(honor_range=False)
+        self.assertEqual(self.download(session), DATA)
+
+    def test_no_content_length(self):
+        session = FakeSession(length=False)
+        self.assertEqual(self.download(session), DATA)
+
+
+if __name__ == '__main__':
+    unittest.main()